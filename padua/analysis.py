@@ -2,6 +2,9 @@ import pandas as pd
 import numpy as np
 import requests
 import warnings
+import hashlib
+import os
+from functools import lru_cache
 import scipy as sp
 from scipy import stats
 
@@ -12,35 +15,52 @@ except ImportError:
 else:
     from sklearn.decomposition import PCA    
 
-
-
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 
 from . import filters, process
-from .utils import get_protein_id
+
+# Location of the on-disk cache of PantherDB GO enrichment responses. Set to None to disable.
+GO_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'padua', 'go')
 
 
 def correlation(df, rowvar=False):
     """
-    Calculate column-wise Pearson correlations using ``numpy.ma.corrcoef``
+    Calculate column-wise Pearson correlations, ignoring NaNs pairwise
 
-    Input data is masked to ignore NaNs when calculating correlations. Data is returned as
-    a Pandas ``DataFrame`` of column_n x column_n dimensions, with column index copied to
-    both axes.
+    Each pair of columns is correlated using only the rows where both columns have valid
+    values. The pairwise sums are calculated with matrix products, so the whole matrix is built
+    in a handful of vectorized operations. Data is returned as a Pandas ``DataFrame`` of
+    column_n x column_n dimensions, with column index copied to both axes.
 
     :param df: Pandas DataFrame
     :return: Pandas DataFrame (n_columns x n_columns) of column-wise correlations
     """
 
-    # Create a correlation matrix for all correlations
-    # of the columns (filled with na for all values)
-    df = df.copy()
-    maskv = np.ma.masked_where(np.isnan(df.values), df.values)
-    cdf = np.ma.corrcoef(maskv, rowvar=False)
-    cdf = pd.DataFrame(np.array(cdf))
+    v = df.values.astype(np.float64)
+    m = ~np.isnan(v)
+
+    # Center on the column means to keep the sums below well-conditioned; Pearson r
+    # is unaffected by a per-column shift. NaNs are zeroed so they drop out of the products.
+    v = v - np.nanmean(v, axis=0)
+    v[~m] = 0
+    mf = m.astype(np.float64)
+
+    n = np.dot(mf.T, mf)             # Number of rows valid in both columns i, j
+    sx = np.dot(v.T, mf)             # Sum of column i over rows where j is valid
+    sxx = np.dot((v * v).T, mf)      # Sum of squares of column i over rows where j is valid
+    sxy = np.dot(v.T, v)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx * sx.T / n
+        var = sxx - sx * sx / n
+        r = cov / np.sqrt(var * var.T)
+
+    r[n < 2] = np.nan
+
+    cdf = pd.DataFrame(r)
     cdf.columns = df.columns
     cdf.index = df.columns
     cdf = cdf.sort_index(level=0, axis=1)
@@ -70,19 +90,22 @@ def pca(df, n_components=2, mean_center=False, **kwargs):
         
     from sklearn.decomposition import PCA
 
-    df = df.copy()
-    
-    # We have to zero fill, nan errors in PCA
-    df[ np.isnan(df) ] = 0
+    # We have to zero fill, nan errors in PCA. Works on a copy of the values; df is untouched.
+    X = np.nan_to_num(df.values.astype(np.float64), copy=False)
 
     if mean_center:
-        mean = np.mean(df.values, axis=0)
-        df = df - mean
+        X -= np.mean(X, axis=0)
+
+    X = X.T
+
+    # Only a few components are needed; the randomized solver avoids a full SVD
+    if 'svd_solver' not in kwargs and isinstance(n_components, int) and n_components < 0.8 * min(X.shape):
+        kwargs['svd_solver'] = 'randomized'
+        kwargs.setdefault('random_state', 0)
 
     pca = PCA(n_components=n_components, **kwargs)
-    pca.fit(df.values.T)
 
-    scores = pd.DataFrame(pca.transform(df.values.T)).T
+    scores = pd.DataFrame(pca.fit_transform(X)).T
     scores.index = ['Principal Component %d (%.2f%%)' % ( (n+1), pca.explained_variance_ratio_[n]*100 ) for n in range(0, scores.shape[0])]
     scores.columns = df.columns
 
@@ -219,14 +242,8 @@ def plsr(df, v, n_components=2, mean_center=False, scale=True, **kwargs):
 
 
 def _non_zero_sum(df):
-    # Following is just to build the template; actual calculate below
-    dfo = df.sum(axis=0, level=0)
-
-    for c in df.columns.values:
-        dft = df[c]
-        dfo[c] = dft[ dft > 0].sum(axis=0, level=0)
-
-    return dfo
+    # Mask out non-positive values across all columns at once, then sum per group
+    return df.where(df > 0).sum(axis=0, level=0)
 
 
 def enrichment_from_evidence(dfe, modification="Phospho (STY)"):
@@ -249,9 +266,10 @@ def enrichment_from_evidence(dfe, modification="Phospho (STY)"):
 
     dfes = dfe.sum(axis=0, level=[0,1]).T
 
-    columns = dfes.sum(axis=1, level=0).columns
+    dfes_total = dfes.sum(axis=1, level=0)
+    columns = dfes_total.columns
 
-    total = dfes.sum(axis=1, level=0).values.flatten() # Total values
+    total = dfes_total.values.flatten() # Total values
     modified = dfes.iloc[0, dfes.columns.get_level_values('Modifications').values ].values # Modified
     enrichment = modified / total
 
@@ -303,10 +321,11 @@ def sitespeptidesproteins(df, site_localization_probability=0.75):
     :return: ``tuple`` of ``int``, containing sites, peptides, proteins
     """
 
-    sites = filters.filter_localization_probability(df, site_localization_probability)['Sequence window']
-    peptides = set(df['Sequence window'])
-    proteins = set([str(p).split(';')[0] for p in df['Proteins']])
-    return len(sites), len(peptides), len(proteins)
+    # Only the count is needed; don't materialize the filtered DataFrame
+    sites = np.count_nonzero(filters._localization_probability_mask(df, site_localization_probability))
+    peptides = pd.unique(df['Sequence window'].values)
+    proteins = pd.unique(df['Proteins'].astype(str).str.split(';', n=1).str[0].values)
+    return sites, len(peptides), len(proteins)
 
 
 def modifiedaminoacids(df):
@@ -321,18 +340,59 @@ def modifiedaminoacids(df):
              quants ``dict`` of ``int`` keyed by amino acid, giving individual counts for each aa.
     """
 
-    amino_acids = list(df['Amino acid'].values)
-    aas = set(amino_acids)
-    quants = {}
+    aas, counts = np.unique(df['Amino acid'].values, return_counts=True)
+    quants = dict(zip(aas.tolist(), counts.tolist()))
 
-    for aa in aas:
-        quants[aa] = amino_acids.count(aa)
-        
-    total_aas = len(amino_acids)
+    total_aas = int(counts.sum())
 
     return total_aas, quants
 
 
+@lru_cache(maxsize=128)
+def _panther_go_enrichment(ids, organism, enrichment):
+    """
+    Request a GO enrichment table from PantherDB for a ``tuple`` of gene IDs.
+
+    Results are cached in memory, and pickled to `GO_CACHE_DIR` (if set) so repeat
+    queries for the same gene list skip the web service entirely. Failed requests raise,
+    rather than returning, so that they are never cached.
+    """
+    cache_file = None
+    if GO_CACHE_DIR:
+        key = hashlib.sha1("\n".join(ids + (organism, enrichment)).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(GO_CACHE_DIR, key + '.pkl')
+
+        if os.path.exists(cache_file):
+            return pd.read_pickle(cache_file)
+
+    r = requests.post("http://www.pantherdb.org/webservices/garuda/tools/enrichment/VER_2/enrichment.jsp", data={
+            'organism': organism,
+            'type': 'enrichment',
+            'enrichmentType': enrichment},
+            files = {
+            'geneList': ('genelist.txt', StringIO("\n".join(ids)) ),
+
+            },
+            stream=True
+        )
+
+    try:
+        r.raise_for_status()
+        # Parse the response as it arrives, rather than buffering the whole body first
+        r.raw.decode_content = True
+        go = pd.read_csv(r.raw, sep='\t', skiprows=5, lineterminator='\n', header=None)
+    finally:
+        r.close()
+
+    go.columns = ["GO", "Name", "Gene ID", "P", "FDR"]
+
+    if cache_file:
+        os.makedirs(GO_CACHE_DIR, exist_ok=True)
+        go.to_pickle(cache_file)
+
+    return go
+
+
 def go_enrichment(df, enrichment='function', organism='Homo sapiens', summary=True, fdr=0.05, ids_from=['Proteins','Protein IDs']):
     """
     Calculate gene ontology (GO) enrichment for a specified set of indices, using the PantherDB GO enrichment service.
@@ -343,6 +403,9 @@ def go_enrichment(df, enrichment='function', organism='Homo sapiens', summary=Tr
     the cut-off to use for filtering the results. If `summary` is ``True`` (default) the returned ``DataFrame``
     contains just the ontology summary and FDR.
 
+    Responses from PantherDB are cached, in memory and on disk under `GO_CACHE_DIR`, so repeated
+    requests for the same set of IDs return immediately.
+
     :param df: Pandas ``DataFrame`` to
     :param enrichment: ``str`` GO enrichment method to use (one of 'function', 'process', 'cellular_location', 'protein_class', 'pathway')
     :param organism: ``str`` organism name (e.g. "Homo sapiens")
@@ -354,26 +417,24 @@ def go_enrichment(df, enrichment='function', organism='Homo sapiens', summary=Tr
 
     if isinstance(df, pd.DataFrame) or isinstance(df, pd.Series):
         l = list(set(ids_from) & set(df.index.names))[0]
-        data = "\n".join([get_protein_id(s) for s in df.index.get_level_values(l)])
+        ids = pd.Series(df.index.get_level_values(l))
     else:
-        data = "\n".join([get_protein_id(s) for s in df])
+        ids = pd.Series(list(df))
 
-    r = requests.post("http://www.pantherdb.org/webservices/garuda/tools/enrichment/VER_2/enrichment.jsp", data={
-            'organism': organism,
-            'type': 'enrichment',
-            'enrichmentType': enrichment},
-            files = {
-            'geneList': ('genelist.txt', StringIO(data) ),
+    # Vectorized equivalent of get_protein_id: the leading ID, up to the first ';', ' ' or '_'
+    # Drop missing IDs before astype(str), which would otherwise turn them into 'nan'/'None'
+    ids = ids.dropna().astype(str).str.extract(r'^([^; _]*)', expand=False)
 
-            }
-        )
+    # Each ID only needs sending once; peptide-level tables repeat proteins many times
+    ids = pd.unique(ids.values)
 
+    # Sorted so the cache key does not depend on the row order of the input
     try:
-        go = pd.read_csv(StringIO(r.text), sep='\t', skiprows=5, lineterminator='\n', header=None)
+        go = _panther_go_enrichment(tuple(sorted(ids)), organism, enrichment)
     except ValueError:
+        # Unparseable (e.g. empty) response from PantherDB
         return None
 
-    go.columns = ["GO", "Name", "Gene ID", "P", "FDR"]
     go = go.set_index(["GO", "Name"])
     if summary:
         go = go.drop("Gene ID", axis=1).mean(axis=0, level=["GO","Name"])
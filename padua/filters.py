@@ -13,8 +13,7 @@ def remove_rows_matching(df, column, match):
     :param match: ``str`` match target
     :return: Pandas ``DataFrame`` filtered
     """
-    df = df.copy()
-    mask = df[column].values != match
+    mask = ~df[column].eq(match).values
     return df.iloc[mask, :]
 
 
@@ -30,8 +29,7 @@ def remove_rows_containing(df, column, match):
     :param match: ``str`` match target
     :return: Pandas ``DataFrame`` filtered
     """
-    df = df.copy()
-    mask = [match not in str(v) for v in df[column].values]
+    mask = ~df[column].astype(str).str.contains(match, regex=False, na=False).values
     return df.iloc[mask, :]
 
 def remove_reverse(df):
@@ -74,6 +72,11 @@ def remove_only_identified_by_site(df):
     return remove_rows_matching(df, 'Only identified by site', '+')
 
 
+def _localization_probability_mask(df, threshold=0.75):
+    # Boolean row mask of 'Localization prob' >= threshold
+    return df['Localization prob'].values >= threshold
+
+
 def filter_localization_probability(df, threshold=0.75):
     """
     Remove rows with a localization probability below 0.75
@@ -85,8 +88,7 @@ def filter_localization_probability(df, threshold=0.75):
     :param threshold: Cut-off below which rows are discarded (default 0.75)
     :return: Pandas ``DataFrame``
     """
-    df = df.copy()
-    localization_probability_mask = df['Localization prob'].values >= threshold
+    localization_probability_mask = _localization_probability_mask(df, threshold)
     return df.iloc[localization_probability_mask, :]
 
 
@@ -108,24 +110,40 @@ def minimum_valid_values_in_any_group(df, levels=None, n=1, invalid=np.nan):
     :param invalid: matching invalid value
     :return: filtered Pandas ``DataFrame``
     """
-    df = df.copy()
-    
     if levels is None:
         if 'Group' in df.columns.names:
             levels = [df.columns.names.index('Group')]
+    elif not isinstance(levels, (list, tuple)):
+        levels = [levels]
 
     # Filter by at least 7 (values in class:timepoint) at least in at least one group
     if invalid is np.nan:
-        dfx = ~np.isnan(df)
+        valid = ~np.isnan(df.values)
     else:
-        dfx = df != invalid
-    
-    dfc = dfx.astype(int).sum(axis=1, level=levels)
-    
-    dfm = dfc.max(axis=1) >= n
-    
-    mask = dfm.values
-    
+        valid = df.values != invalid
+
+    # Integer group code for each column, from the selected column index levels
+    if levels:
+        # Combine per-level integer codes (-1 for missing labels, hence the +1) into a single code
+        level_codes = [pd.factorize(df.columns.get_level_values(l)) for l in levels]
+        codes = np.ravel_multi_index(
+            [c + 1 for c, _ in level_codes],
+            [len(u) + 1 for _, u in level_codes]
+        )
+    else:
+        codes = np.zeros((df.shape[1],), dtype=int)
+
+    # Sort columns so each group is contiguous, then count valid values per group in one pass
+    order = np.argsort(codes, kind='mergesort')
+    sorted_codes = codes[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+
+    # Counts can't exceed the number of columns, so use the narrowest accumulator that fits
+    count_dtype = np.uint16 if valid.shape[1] < 2 ** 16 else np.int64
+    group_counts = np.add.reduceat(valid[:, order].view(np.uint8), group_starts, axis=1, dtype=count_dtype)
+
+    mask = group_counts.max(axis=1) >= n
+
     return df.iloc[mask, :]
 
 
@@ -140,14 +158,12 @@ def search(df, match, columns=['Proteins','Protein names','Gene names']):
     :param columns: ``list`` of ``str`` to search for match
     :return: filtered Pandas ``DataFrame``
     """
-    df = df.copy()
     dft = df.reset_index()
     
     mask = np.zeros((dft.shape[0],), dtype=bool)
-    idx = ['Proteins','Protein names','Gene names']
-    for i in idx:
+    for i in columns:
         if i in dft.columns:
-            mask = mask | np.array([match in str(l) for l in dft[i].values])
+            mask |= dft[i].astype(str).str.contains(match, regex=False, na=False).values
 
     return df.iloc[mask]
     
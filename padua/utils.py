@@ -1,4 +1,7 @@
+from functools import lru_cache
+
 import numpy as np
+import pandas as pd
 import scipy as sp
 import scipy.interpolate
 import requests
@@ -105,6 +108,7 @@ def qvalues(pv, m = None, verbose = False, lowmem = False, pi0 = None):
     return qv
 
 
+@lru_cache(maxsize=100000)
 def get_protein_id(s):
     """
     Return a shortened string, split on spaces, underlines and semicolons.
@@ -122,9 +126,10 @@ def get_protein_id(s):
     return str(s).split(';')[0].split(' ')[0].split('_')[0]
 
 
+@lru_cache(maxsize=100000)
 def get_protein_ids(s):
     """
-    Return a list of shortform protein IDs.
+    Return a tuple of shortform protein IDs.
 
     Extract all protein IDs from a string containing
     protein IDs in MaxQuant output format: e.g. P07830;P63267;Q54A44;P63268
@@ -134,9 +139,9 @@ def get_protein_ids(s):
 
     :param s:  protein IDs in MaxQuant format
     :type s: str or unicode
-    :return: list of string ids
+    :return: tuple of string ids
     """
-    return [p.split(' ')[0].split('_')[0]  for p in s.split(';') ]
+    return tuple(p.split(' ')[0].split('_')[0]  for p in s.split(';'))
 
 
 def get_protein_id_list(df, level=0):
@@ -155,13 +160,17 @@ def get_protein_id_list(df, level=0):
     :type level: int or str
     :return: list of string ids
     """
-    protein_list = []
-    for s in df.index.get_level_values(level):
-        protein_list.extend( get_protein_ids(s) )
+    values = df.index.get_level_values(level).astype(str)
+    if not len(values):
+        return []
 
-    return list(set(protein_list))
+    # Flatten all rows to a single Series of IDs, then strip names/isoforms in pandas' string methods
+    ids = pd.Series(';'.join(values).split(';'))
+    ids = ids.str.split(' ', n=1).str[0].str.split('_', n=1).str[0]
+    return ids.unique().tolist()
 
 
+@lru_cache(maxsize=100000)
 def get_shortstr(s):
     """
     Return the first part of a string before a semicolon.
@@ -265,18 +274,9 @@ def chunks(seq, num):
     :type seq: np.array
     :param num: Number of parts to split sequence into
     :type num: int
-    :return: np.array of split parts
+    :return: list of split parts (views of `seq`)
     """
-
-    avg = len(seq) / float(num)
-    out = []
-    last = 0.0
-
-    while last < len(seq):
-        out.append(seq[int(last):int(last + avg)])
-        last += avg
-
-    return np.array(out)
+    return np.array_split(seq, num)
 
 
 def calculate_s0_curve(s0, minpval, maxpval, minratio, maxratio, curve_interval=0.1):
@@ -294,7 +294,8 @@ def calculate_s0_curve(s0, minpval, maxpval, minratio, maxratio, curve_interval=
     :param minratio: `float` minimum ratio
     :param maxratio: `float` maximum ratio
     :param curve_interval: `float` stepsize (smoothness) of curve generator
-    :return: x, y, fn  x,y points of curve, and fn generator
+    :return: x, y, params  x,y points of curve, and the (s0, minratio, mminpval) curve parameters,
+             where y = 10 ** (-s0/(x-minratio) - mminpval)
     """
 
     mminpval = -np.log10(minpval)
@@ -311,23 +312,37 @@ def calculate_s0_curve(s0, minpval, maxpval, minratio, maxratio, curve_interval=
     else:
         x = np.arange(max_x, ax0, curve_interval)
 
-    fn = lambda x: 10 ** (-s0/(x-minratio) - mminpval)
-    y = fn(x)
+    y = 10 ** (-s0/(x-minratio) - mminpval)
 
-    return x, y, fn
+    return x, y, (s0, minratio, mminpval)
 
 
 def find_nearest_idx(array,value):
     """
+    Return the index of the value in `array` nearest to `value`, ignoring NaNs.
+
+    :param array:
+    :param value:
+    :return:
+    """
+    return int(np.nanargmin(np.abs(np.subtract(array, value))))
+
+def find_nearest_sorted_idx(array, value):
+    """
+    Return the index of the value in sorted (ascending) `array` nearest to `value`.
+
+    Uses a binary search, so `array` must be sorted and free of NaNs. `value` can be a scalar
+    or an array of values, returning an index for each.
 
     :param array:
     :param value:
     :return:
     """
-    array = array.copy()
-    array[np.isnan(array)] = 1
-    idx = (np.abs(array-value)).argmin()
-    return idx
+    array = np.asarray(array)
+    right = np.minimum(np.searchsorted(array, value), len(array)-1)
+    left = np.maximum(right-1, 0)
+    return np.where(np.subtract(value, array[left]) <= np.subtract(array[right], value), left, right)
+
 
 def get_uniprot_id_mapping_pairs(f, t, seqids):
 
@@ -15,37 +15,32 @@ np.seterr(all='ignore')
 
 import warnings
 
+try:
+    import fastcluster
+except ImportError:
+    fastcluster = False
+
 import scipy.spatial.distance as distance
 import scipy.cluster.hierarchy as sch
 
-import matplotlib
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
-import matplotlib.image as mplimg
 import matplotlib.cm as cm
 
 from matplotlib.cm import viridis, ScalarMappable
-from matplotlib.colors import Normalize
+from matplotlib.colors import Normalize, to_rgba_array
 
 from matplotlib.patches import Ellipse
-from matplotlib.colors import colorConverter
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-
-from io import BytesIO, StringIO
 
 from adjustText import adjust_text
 
 from . import analysis
 from . import process
-from .utils import qvalues, get_protein_id, get_protein_ids, get_protein_id_list, get_shortstr, get_index_list, build_combined_label, \
-                   hierarchical_match, chunks, calculate_s0_curve, find_nearest_idx, format_label, get_uniprot_id_mapping_pairs
-
-
-from PIL import Image
+from .utils import qvalues, get_shortstr, get_index_list, build_combined_label, \
+                   hierarchical_match, calculate_s0_curve, find_nearest_sorted_idx, format_label, get_uniprot_id_mapping_pairs
 
 import requests
-from requests_toolbelt import MultipartEncoder
 
 import re
 
@@ -54,6 +49,9 @@ uniprot_kegg_cache = {}
 
 OPTIMIZE_LABEL_ITER_DEFAULT = 100
 
+# Maximum number of points drawn in each correlation scatter inlay
+CORRELATION_SCATTER_MAX_POINTS = 5000
+
 
 # Add ellipses for confidence intervals, with thanks to Joe Kington
 # http://stackoverflow.com/questions/12301071/multidimensional-confidence-intervals
@@ -99,9 +97,9 @@ def plot_cov_ellipse(cov, pos, nstd=2, **kwargs):
     """
 
     def eigsorted(cov):
+        # eigh returns eigenvalues in ascending order, so reverse for descending
         vals, vecs = np.linalg.eigh(cov)
-        order = vals.argsort()[::-1]
-        return vals[order], vecs[:, order]
+        return vals[::-1], vecs[:, ::-1]
 
     vals, vecs = eigsorted(cov)
     theta = np.degrees(np.arctan2(*vecs[:, 0][::-1]))
@@ -149,6 +147,10 @@ def _pca_scores(
     ax = fig.add_subplot(1,1,1)
     levels = [0,1]    
 
+    # Gather all groups' points and styles, so they can be drawn with a single scatter
+    xs, ys, fcs, ecs, sizes = [], [], [], [], []
+    ellipse_groups = []
+
     for c in set(scores.columns.values):
 
         try:
@@ -171,12 +173,40 @@ def _pca_scores(
         else:
             s = markersize
 
-        ax.scatter(data[pc1,:], data[pc2,:], s=s, marker=marker, edgecolors=ec, c=fc)
+        n = data.shape[1]
+        xs.append(data[pc1,:])
+        ys.append(data[pc2,:])
+        fcs.extend([fc] * n)
+        ecs.extend([ec] * n)
+        sizes.extend([s] * n)
+
+        if show_covariance_ellipse and n > 2:
+            ellipse_groups.append((data[[pc1, pc2], :].T, ec or fc))
+
+    if xs:
+        ax.scatter(np.concatenate(xs), np.concatenate(ys), s=sizes, marker=marker,
+                   edgecolors=to_rgba_array(ecs), c=to_rgba_array(fcs))
+
+    if ellipse_groups:
+        # Batch the covariance/eigen decomposition for all groups, padding smaller groups with NaN
+        nstd = 2
+        npts = np.array([len(points) for points, _ in ellipse_groups])
+        pts = np.full((len(ellipse_groups), npts.max(), 2), np.nan)
+        for g, (points, _) in enumerate(ellipse_groups):
+            pts[g, :len(points)] = points
+
+        pos = np.nanmean(pts, axis=1)
+        centered = np.nan_to_num(pts - pos[:, None, :])
+        cov = np.einsum('gni,gnj->gij', centered, centered) / (npts - 1)[:, None, None]
+
+        # eigh returns eigenvalues in ascending order; the last is the major axis
+        vals, vecs = np.linalg.eigh(cov)
+        thetas = np.degrees(np.arctan2(vecs[:, 1, -1], vecs[:, 0, -1]))
+        widths, heights = 2 * nstd * np.sqrt(vals[:, -1]), 2 * nstd * np.sqrt(vals[:, 0])
 
-        if show_covariance_ellipse and data.shape[1] > 2:
-            cov = data[[pc1, pc2], :].T
-            ellip = plot_point_cov(cov, nstd=2, linestyle='dashed', linewidth=0.5, edgecolor=ec or fc,
-                                   alpha=0.8)  #**kwargs for ellipse styling
+        for g, (_, ec) in enumerate(ellipse_groups):
+            ellip = Ellipse(xy=pos[g], width=widths[g], height=heights[g], angle=thetas[g], fill=False,
+                            linestyle='dashed', linewidth=0.5, edgecolor=ec, alpha=0.8)  #**kwargs for ellipse styling
             ax.add_artist(ellip)
 
     if label_scores:
@@ -220,7 +250,7 @@ def _pca_weights(
     """
     fig = plt.figure(figsize=(8, 8))
     ax = fig.add_subplot(1,1,1)
-    ax.plot(weights.iloc[:, pc].values)
+    ax.plot(weights.iloc[:, pc].values, rasterized=True)
     ylim = np.max( np.abs( weights.values ) ) * 1.1
     ax.set_ylim( -ylim, +ylim  )
     ax.set_xlim(0, weights.shape[0])
@@ -243,9 +273,10 @@ def _pca_weights(
             wti = wti[FILTER]
 
             idxs = get_index_list( wts.index.names, label_weights )
+            wtv = wts.values
+            wtl = wts.index.values
             for x in wti:
-                y = wts.iloc[x]
-                t = ax.text(x, y, build_combined_label( wts.index.values[x], idxs), bbox=dict(boxstyle='round,pad=0.3', fc='#ffffff', ec='none', alpha=0.4))
+                t = ax.text(x, wtv[x], build_combined_label( wtl[x], idxs), bbox=dict(boxstyle='round,pad=0.3', fc='#ffffff', ec='none', alpha=0.4))
                 texts.append(t)
 
         if texts and optimize_label_iter:
@@ -478,7 +509,8 @@ def volcano(df, a, b=None,
             fc='grey',
             fc_sig='blue',
             fc_sigr='red',
-            optimize_label_iter=OPTIMIZE_LABEL_ITER_DEFAULT
+            optimize_label_iter=OPTIMIZE_LABEL_ITER_DEFAULT,
+            label_bbox_max=100
             ):
     """
     Volcano plot of two sample groups showing t-test p value vs. log2(fc).
@@ -502,7 +534,8 @@ def volcano(df, a, b=None,
     :param fdr: `float` false discovery rate cut-off
     :param threshold: `float` log2(fc) ratio cut -off
     :param minimum_sample_n: `int` minimum sample for t-test
-    :param estimate_qvalues: `bool` estimate Q values (adjusted P)
+    :param estimate_qvalues: `bool` estimate Q values (adjusted P) using Benjamini-Hochberg, or `'storey'` to use
+                             the Storey-Tibshirani q-value estimate
     :param labels_from: `str` or `int` index level to get labels from
     :param labels_for: `list` of `str` matching labels to show
     :param title: `str` title for plot
@@ -516,10 +549,10 @@ def volcano(df, a, b=None,
     :param fc: `str` hex or matplotlib color code, default color of points
     :param optimize_label_iter: `50` (default) number of iterations to attempt to optimize label positions.
                                 Increase for clearer positions (longer processing time).
+    :param label_bbox_max: `int` maximum number of labels drawn with a background box. Above this, labels are
+                           drawn as plain text, which is much faster to render for large label sets.
     :return:
     """
-    df = df.copy()
-    
     if np.any(df.values[~pd.isnull(df.values)] < 0) and not is_log2:
         warnings.warn("Input data has negative values. If data is log2 transformed, set is_log2=True.")
 
@@ -533,30 +566,44 @@ def volcano(df, a, b=None,
         # Calculate ratio between two groups
         g1, g2 = df[a].values, df[b].values
 
+        # Valid value counts and sums per row, shared by the group means and the minimum_sample_n mask
+        m1, m2 = ~np.isnan(g1), ~np.isnan(g2)
+        n1, n2 = m1.sum(axis=1), m2.sum(axis=1)
+        mean1 = np.where(m1, g1, 0).sum(axis=1) / n1
+        mean2 = np.where(m2, g2, 0).sum(axis=1) / n2
+
         if is_log2:
-            dr = np.nanmean(g2, axis=1) - np.nanmean(g1, axis=1)
+            dr = mean2 - mean1
         else:
-            dr = np.log2(np.nanmean(g2, axis=1) / np.nanmean(g1, axis=1))
+            dr = np.log2(mean2 / mean1)
 
-        ginv = ( (~np.isnan(g1)).sum(axis=1) < minimum_sample_n ) | ((~np.isnan(g2)).sum(axis=1) < minimum_sample_n)
+        ginv = (n1 < minimum_sample_n) | (n2 < minimum_sample_n)
 
-        g1 = np.ma.masked_where(np.isnan(g1), g1)
-        g2 = np.ma.masked_where(np.isnan(g2), g2)
-
-        # Calculate the p value between two groups (t-test)
-        t, p = sp.stats.mstats.ttest_ind(g1.T, g2.T)
+        # Calculate the p value between two groups (pooled-variance t-test), ignoring missing values
+        ss1 = np.where(m1, g1 - mean1[:, None], 0) ** 2
+        ss2 = np.where(m2, g2 - mean2[:, None], 0) ** 2
+        dof = n1 + n2 - 2
+        pooled_var = (ss1.sum(axis=1) + ss2.sum(axis=1)) / dof
+        t = (mean1 - mean2) / np.sqrt(pooled_var * (1.0 / n1 + 1.0 / n2))
+        p = 2 * sp.stats.t.sf(np.abs(t), dof)
+        # Group variances are undefined with fewer than 2 values
+        p[(n1 < 2) | (n2 < 2)] = np.nan
 
     else:
         g1 = df[a].values
-        dr = np.nanmean(g1, axis=1)
 
-        ginv = (~np.isnan(g1)).sum(axis=1) < minimum_sample_n
+        m1 = ~np.isnan(g1)
+        n1 = m1.sum(axis=1)
+        dr = np.where(m1, g1, 0).sum(axis=1) / n1
+
+        ginv = n1 < minimum_sample_n
 
-        # Calculate the p value one sample t
-        g1 = np.ma.masked_where(np.isnan(g1), g1)
-        t, p = sp.stats.mstats.ttest_1samp(g1.T, popmean=0)
+        # Calculate the p value one sample t, ignoring missing values
+        ss1 = np.where(m1, g1 - dr[:, None], 0) ** 2
+        t = dr / np.sqrt(ss1.sum(axis=1) / (n1 - 1) / n1)
+        p = 2 * sp.stats.t.sf(np.abs(t), n1 - 1)
 
-    p = np.array(p) # Unmask
+    p = np.array(p, dtype=float)
 
     # Set p values to nan where not >= minimum_sample_n values
     p[ ginv ] = np.nan
@@ -567,70 +614,77 @@ def volcano(df, a, b=None,
         ax = fig.add_subplot(1,1,1)
 
     if estimate_qvalues:
-        p[~np.isnan(p)] = qvalues(p[~np.isnan(p)])
+        valid = ~np.isnan(p)
+        if estimate_qvalues == 'storey':
+            p[valid] = qvalues(p[valid])
+        else:
+            from statsmodels.stats.multitest import multipletests
+            p[valid] = multipletests(p[valid], method='fdr_bh')[1]
         ax.set_ylabel('-log$_{10}$(Q)')
     else:
         ax.set_ylabel('-log$_{10}$(p)')
 
 
     # There are values below the fdr
-    s0x, s0y, s0fn = calculate_s0_curve(s0, fdr, min(fdr/2, np.nanmin(p)), np.log2(threshold), np.nanmax(np.abs(dr)), curve_interval=0.001)
+    s0x, s0y, (s0p, s0minratio, s0mminpval) = calculate_s0_curve(s0, fdr, min(fdr/2, np.nanmin(p)), np.log2(threshold), np.nanmax(np.abs(dr)), curve_interval=0.001)
 
     if draw_fdr is True:
         ax.plot(s0x, -np.log10(s0y), fc_sigr, lw=1 )
         ax.plot(-s0x, -np.log10(s0y), fc_sigr, lw=1 )
 
-    # Select data based on s0 curve
-    _FILTER_IN = []
-
-    for x, y in zip(dr, p):
-        x = np.abs(x)
-        spy = s0fn(x)
-
-        if len(s0x) == 0 or x < np.min(s0x):
-            _FILTER_IN.append(False)
-            continue
-
-        if y <= spy:
-            _FILTER_IN.append(True)
-        else:
-            _FILTER_IN.append(False)
+    # Select data based on s0 curve; NaN ratios or p values compare False and are excluded
+    min_s0x = np.min(s0x) if len(s0x) else np.inf
+    absdr = np.abs(dr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spy = np.power(10.0, -s0p / (absdr - s0minratio) - s0mminpval)
 
-    _FILTER_IN = np.array(_FILTER_IN)
+    _FILTER_IN = (absdr >= min_s0x) & (p <= spy)
     _FILTER_OUT = ~ _FILTER_IN
+
+    # -log10(p) for the y-axis, shared by all scatter subsets and labels
+    nlp = -np.log10(p)
     
 
+    # Marker sizes for all points, subset per scatter call below
+    if type(markersize) == str:
+        # Use as a key vs. index value in this levels
+        s_all = np.asarray(df.index.get_level_values(markersize))
+    elif callable(markersize):
+        s_all = np.array([markersize(c) for c in df.index.values])
+    else:
+        s_all = np.full((df.shape[0],), markersize, dtype=float)
+
     def scatter(ax, f, c, alpha=0.5):
         # lw = [float(l[0][-1])/5 for l in df[ f].index.values]
-        
-        if type(markersize) == str:
-            # Use as a key vs. index value in this levels
-            s = df.index.get_level_values(markersize)
-        elif callable(markersize):
-            s = np.array([markersize(c) for c in df.index.values])
-        else:
-            s = np.ones((df.shape[0],))*markersize
-        
-        
-        ax.scatter(dr[f], -np.log10(p[f]), c=c, s=s[f], linewidths=0, alpha=0.5)
+        ax.scatter(dr[f], nlp[f], c=c, s=s_all[f], linewidths=0, alpha=0.5)
     
-    _FILTER_OUT1 = _FILTER_OUT & ~np.isnan(p) & (np.array(p) > fdr)
-    scatter(ax, _FILTER_OUT1, fc, alpha=0.3)
+    _FILTER_OUT1 = _FILTER_OUT & (p > fdr)  # NaN compares False
+    _FILTER_OUT2 = _FILTER_OUT & (p <= fdr)
 
-    _FILTER_OUT2 = _FILTER_OUT & (np.array(p) <= fdr)
+    scatter(ax, _FILTER_OUT1, fc, alpha=0.3)
     scatter(ax, _FILTER_OUT2, fc_sig, alpha=0.3)
 
     if labels_for:
-        texts = []
+        labels = []
         idxs = get_index_list( df.index.names, labels_from )
-        for shown, label, x, y in zip( _FILTER_IN , df.index.values, dr, -np.log10(p)):
+        for shown, label, x, y in zip( _FILTER_IN , df.index.values, dr, nlp):
             
             if shown or not label_sig_only:
                 label = build_combined_label( label, idxs, label_format=label_format)
                 
                 if labels_for == True or any([l in label for l in labels_for]):
-                    t = ax.text(x, y, label , ha='center', va='center', rotation_mode='anchor', bbox=dict(boxstyle='round,pad=0.3', fc='#ffffff', ec='none', alpha=0.4))
-                    texts.append(t)
+                    labels.append((x, y, label))
+
+        # Create the label artists in one go, skipping the background box for large label sets
+        if len(labels) > label_bbox_max:
+            bbox = None
+        else:
+            bbox = dict(boxstyle='round,pad=0.3', fc='#ffffff', ec='none', alpha=0.4)
+
+        texts = [
+            ax.text(x, y, label, ha='center', va='center', rotation_mode='anchor', bbox=bbox)
+            for x, y, label in labels
+        ]
 
         # Adjust spacing/positioning of labels if required.
         if texts and optimize_label_iter:
@@ -769,9 +823,9 @@ def modificationlocalization(df):
     colors =  ["#78c679", "#d9f0a3", "#ffffe5"]
 
     lp = df['Localization prob'].values
-    class_i = np.sum(lp > 0.75)
-    class_ii = np.sum( (lp > 0.5) & (lp <= 0.75 ) )
-    class_iii = np.sum( (lp > 0.25) & (lp <= 0.5 ) )
+    lp = lp[~np.isnan(lp)]
+    # Bin into (<= 0.25, (0.25, 0.5], (0.5, 0.75], > 0.75) in a single pass
+    _, class_iii, class_ii, class_i = np.bincount(np.searchsorted([0.25, 0.5, 0.75], lp, side='left'), minlength=4)
 
     cl = [class_i, class_ii, class_iii]
     total_v = class_i + class_ii + class_iii
@@ -821,7 +875,8 @@ def box(df, s=None, title_from=None, subplots=False, figsize=(18,6), groups=None
     :return: `list` of `Figure`
     """
 
-    df = df.copy()
+    # Shallow copy: only the index is replaced below, the data is never modified
+    df = df.copy(deep=False)
 
     if type(s) == str:
         s = [s]
@@ -830,7 +885,7 @@ def box(df, s=None, title_from=None, subplots=False, figsize=(18,6), groups=None
         title_from = list(df.index.names)
         
     if groups is None:
-        groups = list( set( df.columns.get_level_values(0) ) )
+        groups = list( dict.fromkeys( df.columns.get_level_values(0) ) )
         
     # Build the combined name/info string using label_from; replace the index
     title_idxs = get_index_list( df.index.names, title_from )
@@ -840,6 +895,14 @@ def box(df, s=None, title_from=None, subplots=False, figsize=(18,6), groups=None
         # Filter the table on the match string (s)
         df = df.iloc[ [all([str(si).lower() in l.lower() for si in s]) for l in df.index.values] ]
     
+    # The same column hierarchies recur for every row, so memoize style lookups across figures
+    style_cache = {}
+    def match_style(d, hier, default):
+        key = (id(d), tuple(hier), default)
+        if key not in style_cache:
+            style_cache[key] = hierarchical_match(d, hier, default)
+        return style_cache[key]
+
     figures = []
     # Iterate each matching row, building the correct structure dataframe
     for ix in range(df.shape[0]):
@@ -849,11 +912,13 @@ def box(df, s=None, title_from=None, subplots=False, figsize=(18,6), groups=None
         dfi = process.fold_columns_to_rows(dfi, levels_from=len(df.columns.names)-1)
 
         if subplots:
-            gs = gridspec.GridSpec(1, len(subplots), width_ratios=[dfi[sp].shape[1] for sp in subplots])
+            sizes = dfi.columns.get_level_values(0).value_counts()
+            gs = gridspec.GridSpec(1, len(subplots), width_ratios=[int(sizes.get(sp, 0)) for sp in subplots])
             subplotl = subplots
         elif isinstance(dfi.columns, pd.MultiIndex) and len(dfi.columns.levels) > 1:
             subplotl = dfi.columns.levels[0]
-            gs = gridspec.GridSpec(1, len(subplotl), width_ratios=[dfi[sp].shape[1] for sp in subplotl])
+            sizes = dfi.columns.get_level_values(0).value_counts()
+            gs = gridspec.GridSpec(1, len(subplotl), width_ratios=[int(sizes.get(sp, 0)) for sp in subplotl])
         else:
             # Subplots
             subplotl = [None]
@@ -899,15 +964,15 @@ def box(df, s=None, title_from=None, subplots=False, figsize=(18,6), groups=None
                     hier.append(c)
                     
                 if fcol:
-                    color = hierarchical_match(fcol, hier, None)
+                    color = match_style(fcol, hier, None)
                     if color:
                         dic['boxes'][n].set_color( color )
                 if ecol:
-                    color = hierarchical_match(ecol, hier, None)
+                    color = match_style(ecol, hier, None)
                     if color:
                         dic['boxes'][n].set_edgecolor( color )
                 if hatch:
-                    dic['boxes'][n].set_hatch( hierarchical_match(hatch, hier, '') )
+                    dic['boxes'][n].set_hatch( match_style(hatch, hier, '') )
 
             ax.set_xlabel(xlabel)
             ax.tick_params(axis='both', which='major', labelsize=12)
@@ -942,8 +1007,6 @@ def column_correlations(df, cmap=cm.Reds):
     dfc = dfc.values
 
     # Plot the distributions
-    import matplotlib.pyplot as plt
-    import matplotlib.cm as cm
     fig = plt.figure()
     fig.set_size_inches(12, 12)
     ax = fig.add_subplot(1,1,1)
@@ -951,7 +1014,7 @@ def column_correlations(df, cmap=cm.Reds):
     #vmax = np.max(dfc)
     #vmin = np.min(dfc)
 
-    i = ax.imshow(dfc, cmap=cmap, vmin=0.5, vmax=1.0, interpolation='none')
+    i = ax.imshow(dfc, cmap=cmap, vmin=0.5, vmax=1.0, interpolation='none', rasterized=True)
     ax.figure.colorbar(i)
     ax.set_xticks([])
     ax.set_yticks([])
@@ -1099,22 +1162,22 @@ def rankintensity(df, colors=None, labels_from='Protein names', number_of_annota
     labels = df[labels_from].values
 
     if go_ids_from:
-        ids = df[go_ids_from]
+        ids = df[go_ids_from].values
     else:
         if 'Proteins' in df.columns.values:
-            ids = df['Proteins']
+            ids = df['Proteins'].values
         elif 'Protein IDs' in df.columns.values:
-            ids = df['Protein IDs']
+            ids = df['Protein IDs'].values
         else:
             ids = None
 
     y = np.log10(df['Intensity'].values)
 
-    filt = ~np.array( np.isnan(y) | np.isinf(y) )
-    y = y[filt]
-    labels = labels[filt]
+    filt = np.isfinite(y)
+    y = np.compress(filt, y)
+    labels = np.compress(filt, labels)
     if ids is not None:
-        ids = ids[filt]
+        ids = np.compress(filt, ids)
 
     sort = np.argsort(y)
     y = y[sort]
@@ -1131,9 +1194,6 @@ def rankintensity(df, colors=None, labels_from='Protein names', number_of_annota
     ax.set_xlim( (-x_max//3,  x_max+x_max//3) )
     ax.set_ylim( (y_min-1,  y_max+1) )
 
-    # Set the dimensions so we can plot the labels correctly.
-    ax.scatter(x, y, alpha=0, zorder=-1)
-
     ax.set_ylabel("Total intensity ($log_{10}$)")
     ax.set_xlabel("Ranked phosphoproteins")
 
@@ -1145,25 +1205,25 @@ def rankintensity(df, colors=None, labels_from='Protein names', number_of_annota
     text_y_cross = 0.55
     # Build set of standard x offsets at defined y data points
     # For each y slot, find the (nearest) data y, therefore the x
-    text_x_slots = []
     inv =  ax.transLimits.inverted()
-    for ys in text_y_slots:
-        _, yd = inv.transform( (0, ys) )
-        text_x_slots.append( ax.transLimits.transform( (x[find_nearest_idx(y, yd)], 0 ) )[0] )
-    text_x_slots = np.array(text_x_slots)
+    yds = inv.transform( np.column_stack([np.zeros_like(text_y_slots), text_y_slots]) )[:, 1]
+
+    # y is sorted, so find the nearest data point to each slot by binary search
+    idx = find_nearest_sorted_idx(y, yds)
+    text_x_slots = ax.transLimits.transform( np.column_stack([x[idx], np.zeros_like(yds)]) )[:, 0]
 
     text_x_slots[text_y_slots < text_y_cross] += 0.15
     text_x_slots[text_y_slots > text_y_cross] -= 0.15
 
     def annotate_obj(ax, n, labels, xs, ys, idx, yd, ha):
         """
+        Annotate points with pre-shortened `labels`; points with a label of None are skipped.
         """
 
         ni = 1
         previous = {}
         for l, xi, yi in zip(labels, xs, ys):
-            if type(l) == str:
-                l = get_shortstr(l)
+            if l is not None:
 
                 if l in previous: # Use previous text slot for annotation; skip annotation part
                     axf, ayf = previous[l]
@@ -1190,8 +1250,12 @@ def rankintensity(df, colors=None, labels_from='Protein names', number_of_annota
 
     _n = np.min([labels.shape[0], 20])
 
-    annotate_obj(ax, number_of_annotations, labels[-1:-_n:-1], x[-1:-_n:-1], y[-1:-_n:-1], -1, -1, 'right')
-    annotate_obj(ax, number_of_annotations, labels[:_n], x[:_n], y[:_n], 0, +1, 'left')
+    # Only the top/bottom ranked points can be annotated, so only shorten those labels
+    def short_labels(ls):
+        return [get_shortstr(l) if type(l) == str else None for l in ls]
+
+    annotate_obj(ax, number_of_annotations, short_labels(labels[-1:-_n:-1]), x[-1:-_n:-1], y[-1:-_n:-1], -1, -1, 'right')
+    annotate_obj(ax, number_of_annotations, short_labels(labels[:_n]), x[:_n], y[:_n], 0, +1, 'left')
 
     if show_go_enrichment and ids is not None:
 
@@ -1210,28 +1274,49 @@ def rankintensity(df, colors=None, labels_from='Protein names', number_of_annota
             cmap = mpl.colors.LinearSegmentedColormap.from_list('custom', list(colors), len(segments))
             colors = [mpl.colors.rgb2hex(cmap(n)) for n in range(len(segments))]
 
+        # Assign each point to the segment strictly containing it (-1 for points on an edge or outside all)
+        edges = np.array([s for s, _ in segments] + [segments[-1][1]], dtype=float)
+        bins = np.searchsorted(edges, y, side='left') - 1
+        bins[(bins < 0) | (bins >= len(segments)) | np.isin(y, edges)] = -1
+
+        # Points of each segment as contiguous runs of a stable ordering by segment
+        order = np.argsort(bins, kind='mergesort')
+        bounds = np.searchsorted(bins[order], np.arange(len(segments) + 1))
+
+        # IDs found only within a single segment, for comparison relative to background
+        id_bins = pd.DataFrame({'id': ids, 'bin': bins}).drop_duplicates()
+        exclusive = id_bins.drop_duplicates('id', keep=False)
+        gids_by_bin = {b: g['id'].tolist() for b, g in exclusive.groupby('bin')}
+
         for n, (s, e) in enumerate(segments):
             if progress_callback:
                 progress_callback(float(n)/len(segments))
 
-            mask = (y > s) & (y < e)
-            c = x[mask]
+            c = x[order[bounds[n]:bounds[n+1]]]
 
             # Comparison relative to background
-            gids = list(set(ids[mask]) - set(ids[~mask]))
+            gids = gids_by_bin.get(n, [])
             go = analysis.go_enrichment(gids, enrichment=go_enrichment, fdr=go_fdr)
 
             if go is not None:
                 labels = [gi[1] for gi in go.index]
 
-                # Filter out less specific GO terms where specific terms exist (simple text matching)
+                # Filter out less specific GO terms where specific terms exist (simple text matching).
+                # Only longer labels can contain a label, so check against those, longest first.
+                longest_first = sorted(set(labels), key=len, reverse=True)
                 labels_f = []
                 for l in labels:
-                    for ll in labels:
-                        if l in ll and l != ll:
+                    for ll in longest_first:
+                        if len(ll) <= len(l):
+                            labels_f.append(l)
+                            break
+                        if l in ll:
                             break
                     else:
                         labels_f.append(l)
+
+                    if go_max_labels is not None and len(labels_f) >= go_max_labels:
+                        break
                 labels = labels_f[:go_max_labels]
 
                 yr = ax.transLimits.transform( (0, y[c[0]]) )[1], ax.transLimits.transform( (0, y[c[-1]]) )[1]
@@ -1242,7 +1327,12 @@ def rankintensity(df, colors=None, labels_from='Protein names', number_of_annota
                 else:
                     yr = yr[0]+slot_size, yr[1]
 
-                yr = find_nearest_idx(text_y_slots, yr[0]), find_nearest_idx(text_y_slots, yr[1])
+                # Search only the unused (non-NaN) slots, which remain sorted, and map back to slot indices
+                free_slots = np.flatnonzero(~np.isnan(text_y_slots))
+                if len(free_slots):
+                    yr = free_slots[find_nearest_sorted_idx(text_y_slots[free_slots], yr)]
+                else:
+                    yr = (0, 0)
 
                 yrange = list(range(yr[0], yr[1]))
 
@@ -1265,8 +1355,9 @@ def rankintensity(df, colors=None, labels_from='Protein names', number_of_annota
                         ha = 'left'
                     ax.text(axf, ayf, l, transform=ax.transAxes, ha=ha, color=colors[n])
 
-            # Calculate GO enrichment terms for each region?
-            ax.scatter(x[mask], y[mask], s=15, c=colors[n], lw=0, zorder=100)
+        # Plot all segment points in one collection, colored by segment
+        in_segment = bins >= 0
+        ax.scatter(x[in_segment], y[in_segment], s=15, c=to_rgba_array(colors)[bins[in_segment]], lw=0, zorder=100)
 
     else:
             ax.scatter(x, y, s=15, c='k', lw=0, zorder=100)
@@ -1325,18 +1416,28 @@ def correlation(df, cm=cm.PuOr_r, vmin=None, vmax=None, labels=None, show_scatte
     fig.axes[0].grid('off')
 
     if show_scatter:
+        from io import BytesIO
+        import matplotlib.image as mplimg
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
         figo = mpl.figure.Figure(figsize=(n_dims, n_dims), dpi=300)
         # Create a dummy Agg canvas so we don't have to display/output this intermediate
         canvas = FigureCanvasAgg(figo)
 
+        # Subsample rows for the scatter inlays; extra points are not distinguishable at this size
+        values = df.values
+        if values.shape[0] > CORRELATION_SCATTER_MAX_POINTS:
+            rows = np.random.RandomState(0).choice(values.shape[0], CORRELATION_SCATTER_MAX_POINTS, replace=False)
+            values = values[np.sort(rows)]
+
         for x in range(0, n_dims):
             for y in range(x, n_dims):
 
                 ax = figo.add_subplot(n_dims, n_dims, y*n_dims+x+1)
 
                 if x != y:
-                    xd = df.values[:, x]
-                    yd = df.values[:, y]
+                    xd = values[:, x]
+                    yd = values[:, y]
                     ax.scatter(xd, yd, lw=0, s=5, c='k', alpha=0.2)
 
                 ax.grid('off')
@@ -1371,15 +1472,15 @@ def correlation(df, cm=cm.PuOr_r, vmin=None, vmax=None, labels=None, show_scatte
     return fig
 
 
-def _areadist(ax, v, xr, c, bins=100, by=None, alpha=1, label=None):
+def _areadist(ax, v, edges, c, by=None, alpha=1, label=None):
     """
-    Plot the histogram distribution but as an area plot
+    Plot the histogram distribution (over bin `edges`) but as an area plot
     """
-    y, x = np.histogram(v[~np.isnan(v)], bins)
-    x = x[:-1]
+    y, _ = np.histogram(v[~np.isnan(v)], edges)
+    x = edges[:-1]
 
     if by is None:
-        by = np.zeros((bins,))
+        by = np.zeros((len(edges) - 1,))
 
     ax.fill_between(x, y, by, facecolor=c, alpha=alpha, label=label)
     return y
@@ -1404,31 +1505,38 @@ def compareimputed(df1, df2, bins=50):
     fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(30, 10))
 
     xr = np.nanmin( [np.nanmin(df1), np.nanmin(df2)] ), np.nanmax( [np.nanmax(df1), np.nanmax(df2)] )
+    # Shared bin edges, so all distributions are directly comparable
+    edges = np.linspace(xr[0], xr[1], bins + 1)
 
     ax1.set_title('Distributions of A and B')
-    _areadist(ax1, df2.values, xr, c='r', bins=bins)
-    _areadist(ax1, df1.values, xr, c='k', bins=bins, alpha=0.3)
+    _areadist(ax1, df2.values, edges, c='r')
+    _areadist(ax1, df1.values, edges, c='k', alpha=0.3)
     ax1.set_xlabel('Value')
     ax1.set_ylabel('Count')
 
     ax2.set_title('Distributions of A and values unique to B')
     # Calculate what is different isolate those values
-    _areadist(ax2, df2.values[ df2.values != df1.values ], xr, c='r', bins=bins)
-    _areadist(ax2, df1.values, xr, c='k', bins=bins, alpha=0.3)
+    diff = np.not_equal(df2.values, df1.values)
+    unique_b = df2.values[diff]
+    _areadist(ax2, unique_b, edges, c='r')
+    _areadist(ax2, df1.values, edges, c='k', alpha=0.3)
     ax2.set_xlabel('Value')
     ax2.set_ylabel('Count')
 
     # Calculate (at the lowest column index level) the difference between
     # distribution of unique values, vs those in common
-    # Get indices of difference
-    dfc= df1.copy()
-    dfc[:] = (df2.values != df1.values).astype(int)
-    for i in dfc.columns.values:
-        dfc[i[:-1]] = np.max(dfc[i[:-1]].values, axis=1)
+    # Get indices of difference, then mark every column of a group (all but the lowest level)
+    # where any of the group's columns differ in that row
+    group_codes, _ = df1.columns.droplevel(-1).factorize()
+    order = np.argsort(group_codes, kind='mergesort')
+    sorted_codes = group_codes[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    group_diff = np.maximum.reduceat(diff[:, order], group_starts, axis=1)
+    associated = group_diff[:, group_codes]
 
     ax3.set_title('Distributions of associated values of A and substituted values in B')
-    _areadist(ax3, df2.values[ df2.values != df1.values ], xr, c='r')
-    _areadist(ax3, df1.values[ dfc.values == 1 ], xr, c='k', alpha=0.3)
+    _areadist(ax3, unique_b, edges, c='r')
+    _areadist(ax3, df1.values[ associated ], edges, c='k', alpha=0.3)
     ax3.set_xlabel('Value')
     ax3.set_ylabel('Count')
 
@@ -1475,10 +1583,11 @@ def comparedist(df, *args, **kwargs):
         dfn = df[selector]
 
         xr = np.nanmin( [np.nanmin(df1), np.nanmin(dfn)] ), np.nanmax( [np.nanmax(df1), np.nanmax(dfn)] )
+        edges = np.linspace(xr[0], xr[1], bins + 1)
 
         ax1.set_title('Distributions of %s and %s' % (base_selector, selector))
-        _areadist(ax1, dfn.values, xr, c='r', bins=bins, label=format_label(base_selector, base_fmt))
-        _areadist(ax1, df1.values, xr, c='k', bins=bins, alpha=0.3, label=format_label(selector, arg_fmt))
+        _areadist(ax1, dfn.values, edges, c='r', label=format_label(base_selector, base_fmt))
+        _areadist(ax1, df1.values, edges, c='k', alpha=0.3, label=format_label(selector, arg_fmt))
 
         ax1.set_xlabel(xlabel)
         ax1.set_ylabel(ylabel)
@@ -1508,6 +1617,9 @@ def kegg_pathway(df, pathway, a, b=None, ids_from="Proteins", cmap=cm.PuOr_r, is
     :param z_score:
     :return:
     """
+    from io import StringIO
+    from PIL import Image
+    from requests_toolbelt import MultipartEncoder
 
     df = df.copy()
 
@@ -1663,51 +1775,62 @@ def quality_control(df):
 
 
 def _optimize_clusters(clusters, denD, target_n):
-    target_n = target_n - 1  # We return edges; not regions
-    threshold = np.max(clusters)
-    max_iterations = threshold
+    # Cut the tree into (at most) target_n flat clusters, then return the edges between them in leaf order
+    cc = sch.fcluster(clusters, target_n, criterion='maxclust')
+    cco = cc[denD['leaves']]
+    return np.flatnonzero(cco[1:] != cco[:-1]).tolist()
 
-    i = 0
-    while i < max_iterations:
-        cc = sch.fcluster(clusters, threshold, 'distance')
-        cco = cc[denD['leaves']]
-        edges = [n for n in range(cco.shape[0] - 1) if cco[n] != cco[n + 1]]
-        n_clusters = len(edges)
 
-        if n_clusters == target_n:
-            break
+def _linkage(v, method, distance_fn, optimal_ordering=False):
+    """
+    Hierarchical clustering linkage of the rows of `v`, using fastcluster when installed.
 
-        if n_clusters < target_n:
-            threshold = threshold // 2
+    :param v: 2D ``np.array`` of observations (rows)
+    :param method: ``str`` linkage method
+    :param distance_fn: function returning condensed pairwise distances of `v`
+    :param optimal_ordering: ``bool`` reorder the linkage so the distance between successive leaves is minimal
+    :return: linkage matrix
+    """
+    if fastcluster and distance_fn is distance.pdist and method in ('single', 'ward', 'centroid', 'median') and not optimal_ordering:
+        # Memory-saving algorithm working directly on the observations (euclidean, as pdist default)
+        return fastcluster.linkage_vector(v, method=method)
 
-        elif n_clusters > target_n:
-            threshold = int(threshold * 1.5)
+    dists = distance_fn(v)
+    if fastcluster:
+        clusters = fastcluster.linkage(dists, method=method)
+    else:
+        clusters = sch.linkage(dists, method=method)
 
-        i += 1
+    if optimal_ordering:
+        clusters = sch.optimal_leaf_ordering(clusters, dists)
 
-    return edges
+    return clusters
 
 
-def _cluster(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False, n_row_clusters=False, z_score=0, method='ward',rdistance_fn=distance.pdist, cdistance_fn=distance.pdist ):
-    dfc = df.copy()
+def _cluster(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False, n_row_clusters=False, z_score=0, method='ward',rdistance_fn=distance.pdist, cdistance_fn=distance.pdist, optimal_ordering=False, copy=True ):
+    # With copy=False, float64 input is normalized in place where the underlying buffer allows
+    v = df.values.astype(np.float64, copy=copy)
+    if not v.flags.writeable:
+        v = v.copy()
 
     if z_score is None:
         pass
-    elif z_score == 0:
-        dfc = (dfc - dfc.median(axis=0)) / dfc.std(axis=0)
-    elif z_score == 1:
-        dfc = ((dfc.T - dfc.median(axis=1).T) / dfc.std(axis=1).T).T
+    elif z_score in (0, 1):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            v -= np.nanmedian(v, axis=z_score, keepdims=True)
+            v /= np.nanstd(v, axis=z_score, ddof=1, keepdims=True)
 
     # Remove nan/infs
-    dfc[np.isinf(dfc)] = 0
-    dfc[np.isnan(dfc)] = 0
+    v[~np.isfinite(v)] = 0
+    dfc = pd.DataFrame(v, index=df.index, columns=df.columns)
 
     # dfc.dropna(axis=0, how='any', inplace=True)
 
+    edges = []
+
     # cluster
     if cluster_rows:
-        row_pairwise_dists = distance.squareform(rdistance_fn(dfc))
-        row_clusters = sch.linkage(row_pairwise_dists, method=method)
+        row_clusters = _linkage(dfc.values, method, rdistance_fn, optimal_ordering)
         row_denD = sch.dendrogram(row_clusters, color_threshold=np.inf, no_plot=True)
 
         col_denD = {'leaves': range(0, dfc.shape[1])}
@@ -1717,8 +1840,7 @@ def _cluster(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False, n_
             edges = _optimize_clusters(row_clusters, row_denD, n_row_clusters)
 
     if cluster_cols:
-        col_pairwise_dists = distance.squareform(cdistance_fn(dfc.T))
-        col_clusters = sch.linkage(col_pairwise_dists, method=method)
+        col_clusters = _linkage(dfc.values.T, method, cdistance_fn, optimal_ordering)
         col_denD = sch.dendrogram(col_clusters, color_threshold=np.inf, no_plot=True)
 
         row_denD = {'leaves': range(0, dfc.shape[0])}
@@ -1730,7 +1852,7 @@ def _cluster(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False, n_
     return dfc, row_clusters, row_denD, col_clusters, col_denD, edges
 
 
-def hierarchical(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False, n_row_clusters=False, row_labels=True, col_labels=True, fcol=None, z_score=0, method='ward', cmap=cm.PuOr_r, return_clusters=False, rdistance_fn=distance.pdist, cdistance_fn=distance.pdist ):
+def hierarchical(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False, n_row_clusters=False, row_labels=True, col_labels=True, fcol=None, z_score=0, method='ward', cmap=cm.PuOr_r, return_clusters=False, rdistance_fn=distance.pdist, cdistance_fn=distance.pdist, optimal_ordering=False, copy=True ):
     """
     Hierarchical clustering of samples or proteins
 
@@ -1743,8 +1865,8 @@ def hierarchical(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False
     or alternatively, `None`, to turn it off.
 
     If a `n_col_clusters` or `n_row_clusters` is specified, this defines the number of clusters to identify and highlight
-    in the resulting heatmap. At *least* this number of clusters will be selected, in some instances there will be more
-    if 2 clusters rank equally at the determined cutoff.
+    in the resulting heatmap. At *most* this number of clusters will be selected, in some instances there will be fewer
+    if 2 clusters merge at the same height at the determined cutoff.
 
     If specified `fcol` will be used to colour the axes for matching samples.
 
@@ -1758,6 +1880,9 @@ def hierarchical(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False
     :param method: ``str`` describing cluster method, default ward
     :param cmap: matplotlib colourmap for heatmap
     :param return_clusters: ``bool`` return clusters in addition to axis
+    :param optimal_ordering: ``bool`` order dendrogram leaves so the distance between neighbouring rows/columns is
+                             minimal (slower for large inputs)
+    :param copy: ``bool`` if ``False``, z-score and clean float64 data in place, modifying `df`, to avoid a full copy
     :return: matplotlib axis, or axis and cluster data
     """
 
@@ -1774,12 +1899,12 @@ def hierarchical(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False
     dfc, row_clusters, row_denD, col_clusters, col_denD, edges = _cluster(df,
        cluster_cols=cluster_cols, cluster_rows=cluster_rows, n_col_clusters=n_col_clusters,
        n_row_clusters=n_row_clusters, z_score=z_score, method='ward',
-       rdistance_fn=rdistance_fn, cdistance_fn=cdistance_fn
+       rdistance_fn=rdistance_fn, cdistance_fn=cdistance_fn, optimal_ordering=optimal_ordering, copy=copy
                                                )
 
     # make norm
-    vmin = dfc.min().min()
-    vmax = dfc.max().max()
+    vmin = np.min(dfc.values)
+    vmax = np.max(dfc.values)
     vmax = max([vmax, abs(vmin)])  # choose larger of vmin and vmax
     vmin = vmax * -1
 
@@ -1811,7 +1936,7 @@ def hierarchical(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False
         class_idx = dfc.index.names.index('Group')
 
         classcol = [fcol[x] for x in dfc.index.get_level_values(0)[row_denD['leaves']]]
-        classrgb = np.array([colorConverter.to_rgb(c) for c in classcol]).reshape(-1, 1, 3)
+        classrgb = to_rgba_array(classcol)[:, None, :3]
         row_cbAX = fig.add_subplot(rowGSSS[0, 1])
         row_axi = row_cbAX.imshow(classrgb, interpolation='nearest', aspect='auto', origin='lower')
         clean_axis(row_cbAX)
@@ -1819,34 +1944,35 @@ def hierarchical(df, cluster_cols=True, cluster_rows=False, n_col_clusters=False
     # heatmap
     heatmapAX = fig.add_subplot(heatmapGS[1, 1])
 
-    axi = heatmapAX.imshow(dfc.iloc[row_denD['leaves'], col_denD['leaves']], interpolation='nearest', aspect='auto', origin='lower'
+    row_leaves, col_leaves = np.asarray(row_denD['leaves']), np.asarray(col_denD['leaves'])
+    axi = heatmapAX.imshow(dfc.values[np.ix_(row_leaves, col_leaves)], interpolation='nearest', aspect='auto', origin='lower'
                            , norm=my_norm, cmap=cmap)
     clean_axis(heatmapAX)
 
 
     def build_labels(index, ixs):
-        zstr = zip(*[index.get_level_values(x) for x in ixs])
-        return np.array([" ".join([str(t) for t in i]) if type(i) == tuple else str(i) for i in zstr])
+        levels = [np.asarray(index.get_level_values(x), dtype=object).astype(str) for x in ixs]
+        if len(levels) == 1:
+            # Single level; the labels are the values themselves
+            return levels[0]
+        return np.array([" ".join(i) for i in zip(*levels)])
 
     # row labels
-    if dfc.shape[0] <= 100:
+    if row_labels and dfc.shape[0] <= 100:
         heatmapAX.set_yticks(range(dfc.shape[0]))
         heatmapAX.yaxis.set_ticks_position('right')
         if row_labels is True:
             row_labels = list(range(len(dfc.index.names)))
-        ylabels = build_labels(dfc.index, row_labels)[row_denD['leaves']]
+        ylabels = build_labels(dfc.index[row_leaves], row_labels)
         heatmapAX.set_yticklabels(ylabels)
 
     # col labels
-    if dfc.shape[1] <= 100:
+    if col_labels and dfc.shape[1] <= 100:
         heatmapAX.set_xticks(range(dfc.shape[1]))
         if col_labels is True:
             col_labels = list(range(len(dfc.columns.names)))
-        xlabels = build_labels(dfc.columns, col_labels)[col_denD['leaves']]
-        xlabelsL = heatmapAX.set_xticklabels(xlabels)
-        # rotate labels 90 degrees
-        for label in xlabelsL:
-            label.set_rotation(90)
+        xlabels = build_labels(dfc.columns[col_leaves], col_labels)
+        heatmapAX.set_xticklabels(xlabels, rotation=90)
 
     # remove the tick lines
     for l in heatmapAX.get_xticklines() + heatmapAX.get_yticklines():
@@ -1895,8 +2021,8 @@ def hierarchical_timecourse(
     or alternatively, `None`, to turn it off.
 
     If a `n_col_clusters` or `n_row_clusters` is specified, this defines the number of clusters to identify and highlight
-    in the resulting heatmap. At *least* this number of clusters will be selected, in some instances there will be more
-    if 2 clusters rank equally at the determined cutoff.
+    in the resulting heatmap. At *most* this number of clusters will be selected, in some instances there will be fewer
+    if 2 clusters merge at the same height at the determined cutoff.
 
     If specified `fcol` will be used to colour the axes for matching samples.
 